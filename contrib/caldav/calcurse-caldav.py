@@ -2,17 +2,29 @@
 
 import argparse
 import base64
+import concurrent.futures
 import configparser
+import io
+import itertools
 import os
 import pathlib
 import re
+import struct
 import subprocess
 import sys
 import textwrap
-import xml.etree.ElementTree as etree
+import threading
+from xml.sax.saxutils import escape
 
 import httplib2
 
+# Use lxml for parsing XML responses if available, fall back to the standard
+# library otherwise.
+try:
+    from lxml import etree
+except ModuleNotFoundError:
+    import xml.etree.ElementTree as etree
+
 # Optional libraries for OAuth2 authentication
 try:
     import webbrowser
@@ -117,6 +129,52 @@ def die_atnode(msg, node):
     die(msg)
 
 
+def iter_multistatus(body):
+    # Parse the multistatus body incrementally instead of building the full
+    # tree. Each child of the root element, usually a response node, is
+    # detached once it has been processed, so only a single one is kept in
+    # memory at a time.
+    context = etree.iterparse(io.BytesIO(body), events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, node in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            yield node
+            root.remove(node)
+
+
+def response_elements(node):
+    # Collect the children of a response node, including the properties
+    # nested in its propstat elements, in a single pass over the subtree
+    # instead of evaluating a path expression for every lookup. If a tag
+    # occurs more than once, the first occurrence is kept.
+    elements = {}
+    for child in node:
+        if child.tag != tag_propstat:
+            elements.setdefault(child.tag, child)
+            continue
+        for prop in child:
+            if prop.tag != tag_prop:
+                continue
+            for elem in prop:
+                elements.setdefault(elem.tag, elem)
+    return elements
+
+
+def response_status(node, elements):
+    statusnode = elements.get(tag_status)
+    if statusnode is None:
+        return None
+    status = re.match(r'HTTP.*(\d\d\d)', statusnode.text)
+    if status is None:
+        die_atnode('Could not parse status.', node)
+    return status.group(1)
+
+
 def validate_sync_filter():
     valid_sync_filter_values = {'event', 'apt', 'recur-event', 'recur-apt', 'todo', 'recur', 'cal'}
     return set(sync_filter.split(',')) - valid_sync_filter_values
@@ -155,18 +213,50 @@ def calcurse_import(icaldata):
     return p.communicate(icaldata.encode('utf-8'))[0].decode('utf-8').rstrip()
 
 
-def calcurse_export(objhash):
+def calcurse_export(objhashes):
     command = calcurse + [
         '-xical',
         '--export-uid',
-        '--filter-hash=' + objhash
+        '--filter-type', sync_filter
     ]
 
     if debug:
         print('Running command: {}'.format(command))
 
     p = subprocess.Popen(command, stdout=subprocess.PIPE)
-    return p.communicate()[0].decode('utf-8').rstrip()
+    out = p.communicate()[0].decode('utf-8').rstrip()
+
+    # Split the export into separate objects, using the UIDs which are set to
+    # the object hashes. Each object is wrapped into its own copy of the
+    # calendar header and footer.
+    header = []
+    objects = {}
+    obj = None
+    for line in out.splitlines():
+        if obj is None:
+            if line in ('BEGIN:VEVENT', 'BEGIN:VTODO'):
+                obj = [line]
+                end = 'END:' + line[len('BEGIN:'):]
+            elif line != 'END:VCALENDAR':
+                header.append(line)
+            continue
+
+        obj.append(line)
+        if line == end:
+            uid = next(x for x in obj if x.startswith('UID:'))[len('UID:'):]
+            objects.setdefault(uid, []).extend(obj)
+            obj = None
+
+    icaldata = {}
+    for objhash in objhashes:
+        if objhash not in objects:
+            warn(('Object {} is no longer present in calcurse and is not '
+                  'pushed to the server.').format(objhash))
+            continue
+        icaldata[objhash] = '\n'.join(header + objects[objhash] +
+                                      ['END:VCALENDAR'])
+
+    return icaldata
 
 
 def calcurse_hashset():
@@ -183,8 +273,15 @@ def calcurse_hashset():
     if debug:
         print('Running command: {}'.format(command))
 
-    p = subprocess.Popen(command, stdout=subprocess.PIPE)
-    return set(p.communicate()[0].decode('utf-8').rstrip().splitlines())
+    # Read the hashes as they are printed instead of buffering the full
+    # output of calcurse.
+    objhashes = set()
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as p:
+        for line in p.stdout:
+            line = line.rstrip()
+            if line:
+                objhashes.add(line.decode('utf-8'))
+    return objhashes
 
 
 def calcurse_remove(objhash):
@@ -278,9 +375,47 @@ def run_auth(authcode):
     return credentials
 
 
-def remote_query(conn, cmd, path, additional_headers, body):
-    headers = custom_headers.copy()
-    headers.update(get_auth_headers())
+def connect():
+    # All connections are created here so that they share the same TLS
+    # settings. Protocol versions older than TLS 1.2 are refused.
+    conn = httplib2.Http(disable_ssl_certificate_validation=insecure_ssl,
+                         tls_minimum_version='TLSv1_2')
+
+    if authmethod == 'oauth2':
+        # Authorize HTTP object with the OAuth2 credentials
+        conn = cred.authorize(conn)
+    else:
+        # Add credentials to httplib2
+        conn.add_credentials(username, password)
+
+    return conn
+
+
+def worker_conn():
+    # httplib2.Http objects are not thread-safe, so each worker thread keeps
+    # a connection of its own.
+    if not hasattr(worker_local, 'conn'):
+        worker_local.conn = connect()
+        worker_conns.append(worker_local.conn)
+    return worker_local.conn
+
+
+def pool_map(func, items):
+    # Call func for each item in the worker pool and return the results in
+    # order. If a call fails, pending calls are cancelled before the error is
+    # passed on.
+    futures = [pool.submit(func, item) for item in items]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def remote_query(conn, cmd, path, additional_headers, body,
+                 die_on_error=True):
+    headers = base_headers.copy()
     if cmd == 'PUT':
         headers['Content-Type'] = 'text/calendar; charset=utf-8'
     else:
@@ -301,8 +436,9 @@ def remote_query(conn, cmd, path, additional_headers, body):
     if isinstance(body, str):
         body = body.encode('utf-8')
 
+    # The response body is returned as bytes, which is what the XML parser
+    # expects anyway.
     resp, body = conn.request(path, cmd, body=body, headers=headers)
-    body = body.decode('utf-8')
 
     if not resp:
         return (None, None)
@@ -310,11 +446,13 @@ def remote_query(conn, cmd, path, additional_headers, body):
     if debug:
         print("< Status: {} ({})".format(resp.status, resp.reason))
         print("< Headers: " + repr(resp))
-        for line in body.splitlines():
+        for line in body.decode('utf-8').splitlines():
             print("< " + line)
         print()
 
     if resp.status - (resp.status % 100) != 200:
+        if not die_on_error:
+            return (None, None)
         die(("The server at {} replied with HTTP status code {} ({}) " +
              "while trying to access {}.").format(hostname, resp.status,
                                                   resp.reason, path))
@@ -322,16 +460,22 @@ def remote_query(conn, cmd, path, additional_headers, body):
     return (resp, body)
 
 
+def multiget_body(props, hrefs):
+    # Join the parts once; appending to the body string for every href
+    # copies it over and over for large requests.
+    parts = ['<?xml version="1.0" encoding="utf-8" ?>'
+             '<C:calendar-multiget xmlns:D="DAV:" '
+             '                     xmlns:C="urn:ietf:params:xml:ns:caldav">'
+             '<D:prop>', props, '</D:prop>']
+    parts.extend('<D:href>{}</D:href>'.format(href) for href in hrefs)
+    parts.append('</C:calendar-multiget>')
+    return ''.join(parts)
+
+
 def get_etags(conn, hrefs=[]):
     if len(hrefs) > 0:
         headers = {}
-        body = ('<?xml version="1.0" encoding="utf-8" ?>'
-                '<C:calendar-multiget xmlns:D="DAV:" '
-                '                     xmlns:C="urn:ietf:params:xml:ns:caldav">'
-                '<D:prop><D:getetag /></D:prop>')
-        for href in hrefs:
-            body += '<D:href>{}</D:href>'.format(href)
-        body += '</C:calendar-multiget>'
+        body = multiget_body('<D:getetag />', hrefs)
     else:
         headers = {'Depth': '1'}
         body = ('<?xml version="1.0" encoding="utf-8" ?>'
@@ -343,16 +487,18 @@ def get_etags(conn, hrefs=[]):
     headers, body = remote_query(conn, "REPORT", absolute_uri, headers, body)
     if not headers:
         return {}
-    root = etree.fromstring(body)
-
     etagdict = {}
-    for node in root.findall(".//D:response", namespaces=nsmap):
-        etagnode = node.find("./D:propstat/D:prop/D:getetag", namespaces=nsmap)
+    for node in iter_multistatus(body):
+        if node.tag != tag_response:
+            continue
+        elements = response_elements(node)
+
+        etagnode = elements.get(tag_getetag)
         if etagnode is None:
             die_atnode('Missing ETag.', node)
         etag = etagnode.text.strip('"')
 
-        hrefnode = node.find("./D:href", namespaces=nsmap)
+        hrefnode = elements.get(tag_href)
         if hrefnode is None:
             die_atnode('Missing href.', node)
         href = hrefnode.text
@@ -362,6 +508,88 @@ def get_etags(conn, hrefs=[]):
     return etagdict
 
 
+def sync_collection(conn, sync_token):
+    # Retrieve the ETags of all objects that changed since the given sync
+    # token, using collection synchronization (RFC 6578). Objects that were
+    # removed are mapped to None. An empty sync token yields all objects.
+    # Returns the changes and the new sync token, or (None, None) if the
+    # server does not support collection synchronization or rejects the
+    # sync token.
+    changes = {}
+    truncated = True
+    while truncated:
+        body = ('<?xml version="1.0" encoding="utf-8" ?>'
+                '<D:sync-collection xmlns:D="DAV:">'
+                '<D:sync-token>{}</D:sync-token>'
+                '<D:sync-level>1</D:sync-level>'
+                '<D:prop><D:getetag /></D:prop>'
+                '</D:sync-collection>').format(escape(sync_token))
+        headers, body = remote_query(conn, "REPORT", absolute_uri,
+                                     {'Depth': '0'}, body, die_on_error=False)
+        if not headers:
+            return (None, None)
+
+        truncated = False
+        sync_token = None
+        for node in iter_multistatus(body):
+            if node.tag == tag_sync_token:
+                sync_token = node.text
+                continue
+            if node.tag != tag_response:
+                continue
+            elements = response_elements(node)
+
+            hrefnode = elements.get(tag_href)
+            if hrefnode is None:
+                die_atnode('Missing href.', node)
+            href = hrefnode.text
+
+            statuscode = response_status(node, elements)
+            if statuscode == '404':
+                changes[href] = None
+                continue
+            elif statuscode == '507':
+                # The server truncated the results. Continue with the sync
+                # token returned in this response.
+                truncated = True
+                continue
+
+            etagnode = elements.get(tag_getetag)
+            if etagnode is None:
+                die_atnode('Missing ETag.', node)
+            changes[href] = etagnode.text.strip('"')
+
+        if not sync_token:
+            return (None, None)
+
+    return (changes, sync_token)
+
+
+def get_etagdict(conn, syncdb, sync_token):
+    # Apply the changes since the last synchronization to the ETags in the
+    # sync database if the server supports collection synchronization.
+    if sync_token:
+        changes, new_sync_token = sync_collection(conn, sync_token)
+        if changes is not None:
+            etagdict = {href: entry[0] for href, entry in syncdb.items()}
+            for href, etag in changes.items():
+                if etag is None:
+                    etagdict.pop(href, None)
+                else:
+                    etagdict[href] = etag
+            return (etagdict, new_sync_token)
+
+    # Otherwise, retrieve all objects. Start over with an empty sync token to
+    # obtain a new one for the next run, if possible.
+    changes, new_sync_token = sync_collection(conn, '')
+    if changes is not None:
+        etagdict = {href: etag for href, etag in changes.items()
+                    if etag is not None}
+        return (etagdict, new_sync_token)
+
+    return (get_etags(conn), None)
+
+
 def remote_wipe(conn):
     if verbose:
         print('Removing all objects from the CalDAV server...')
@@ -369,24 +597,62 @@ def remote_wipe(conn):
         return
 
     remote_items = get_etags(conn)
-    for href in remote_items:
-        remove_remote_object(conn, remote_items[href], href)
+    pool_map(lambda href: remove_remote_object(worker_conn(),
+                                               remote_items[href], href),
+             remote_items)
 
 
 def get_syncdb(fn):
     if not os.path.exists(fn):
-        return {}
+        return ({}, None)
 
     if verbose:
         print('Loading synchronization database from ' + fn + '...')
 
+    with open(fn, 'rb') as f:
+        data = f.read()
+
     syncdb = {}
-    with open(fn, 'r') as f:
-        for line in f.readlines():
-            href, etag, objhash = line.rstrip().split(' ')
-            syncdb[href] = (etag, objhash)
+    sync_token = None
+    try:
+        if data.startswith(syncdb_magic):
+            buf = memoryview(data)
+            pos = len(syncdb_magic)
+            sync_token, pos = syncdb_unpack(buf, pos)
+            while pos < len(buf):
+                href, pos = syncdb_unpack(buf, pos)
+                etag, pos = syncdb_unpack(buf, pos)
+                if pos + syncdb_hashlen > len(buf):
+                    raise ValueError
+                objhash = buf[pos:pos + syncdb_hashlen].hex()
+                pos += syncdb_hashlen
+                syncdb[href] = (etag, objhash)
+        elif data.startswith(b'calcurse-caldav syncdb '):
+            # Binary database in an unknown format version.
+            raise ValueError
+        else:
+            # Read a database in the old text format. It is converted to the
+            # binary format on the next save.
+            for line in data.decode('utf-8').splitlines():
+                href, etag, objhash = line.rstrip().split(' ')
+                syncdb[href] = (etag, objhash)
+    except (struct.error, ValueError):
+        die('Corrupted sync database: {}'.format(fn))
+
+    return (syncdb, sync_token or None)
+
+
+def syncdb_pack(s):
+    s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
 
-    return syncdb
+def syncdb_unpack(buf, pos):
+    length, = struct.unpack_from('!H', buf, pos)
+    pos += 2
+    if pos + length > len(buf):
+        raise ValueError
+    return str(buf[pos:pos + length], 'utf-8'), pos + length
 
 
 def syncdb_add(syncdb, href, etag, objhash):
@@ -401,20 +667,24 @@ def syncdb_remove(syncdb, href):
         print('Removing sync database entry: {}'.format(href))
 
 
-def save_syncdb(fn, syncdb):
+def save_syncdb(fn, syncdb, sync_token):
     if verbose:
         print('Saving synchronization database to ' + fn + '...')
     if dry_run:
         return
 
-    with open(fn, 'w') as f:
-        for href, (etag, objhash) in syncdb.items():
-            print("{} {} {}".format(href, etag, objhash), file=f)
+    # The header holds the length-prefixed sync token. Each entry consists
+    # of the length-prefixed href and ETag, followed by the raw object hash.
+    parts = [syncdb_magic, syncdb_pack(sync_token or '')]
+    for href, (etag, objhash) in syncdb.items():
+        parts += [syncdb_pack(href), syncdb_pack(etag), bytes.fromhex(objhash)]
 
+    with open(fn, 'wb') as f:
+        f.write(b''.join(parts))
 
-def push_object(conn, objhash):
+
+def push_object(conn, objhash, body):
     href = path + objhash + ".ics"
-    body = calcurse_export(objhash)
     headers, body = remote_query(conn, "PUT", hostname_uri + href, {}, body)
 
     if not headers:
@@ -424,7 +694,12 @@ def push_object(conn, objhash):
     # Retrieve href from server to match server-side format. Retrieve ETag
     # unless it can be extracted from the PUT response already.
     ret_href, ret_etag = None, headerdict.get('etag')
+    attempts = 0
     while not ret_etag or not ret_href:
+        if attempts == max_etag_queries:
+            die(('Could not retrieve the ETag of {} from the server after '
+                 'uploading it.').format(href))
+        attempts += 1
         etagdict = get_etags(conn, [href])
         if not etagdict:
             continue
@@ -436,16 +711,26 @@ def push_object(conn, objhash):
     return (ret_href, ret_etag.strip('"'))
 
 
-def push_objects(objhashes, conn, syncdb, etagdict):
+def push_objects(objhashes, syncdb, etagdict):
     # Copy new objects to the server.
-    added = 0
+    if objhashes and not dry_run:
+        icaldata = calcurse_export(objhashes)
+
+    queue = []
     for objhash in objhashes:
         if verbose:
             print("Pushing new object {} to the server.".format(objhash))
-        if dry_run:
+        if dry_run or objhash not in icaldata:
             continue
 
-        href, etag = push_object(conn, objhash)
+        queue.append(objhash)
+
+    # Upload the objects concurrently, using one connection per worker.
+    added = 0
+    results = pool_map(lambda objhash: push_object(worker_conn(), objhash,
+                                                   icaldata[objhash]),
+                       queue)
+    for objhash, (href, etag) in zip(queue, results):
         syncdb_add(syncdb, href, etag, objhash)
         added += 1
 
@@ -457,16 +742,17 @@ def remove_remote_object(conn, etag, href):
     remote_query(conn, "DELETE", hostname_uri + href, headers, None)
 
 
-def remove_remote_objects(objhashes, conn, syncdb, etagdict):
+def remove_remote_objects(objhashes, syncdb, etagdict):
     # Remove locally deleted objects from the server.
-    deleted = 0
-    for objhash in objhashes:
-        queue = []
-        for href, entry in syncdb.items():
-            if entry[1] == objhash:
-                queue.append(href)
+    # Map each object hash to its hrefs once instead of scanning the sync
+    # database for every removed object.
+    hrefs = {}
+    for href, entry in syncdb.items():
+        hrefs.setdefault(entry[1], []).append(href)
 
-        for href in queue:
+    delqueue = []
+    for objhash in objhashes:
+        for href in hrefs.get(objhash, []):
             etag = syncdb[href][0]
 
             if etagdict[href] != etag:
@@ -475,6 +761,7 @@ def remove_remote_objects(objhashes, conn, syncdb, etagdict):
                       'Run the script again to import the modified '
                       'object.').format(objhash))
                 syncdb_remove(syncdb, href)
+                unapplied.add(href)
                 continue
 
             if verbose:
@@ -482,54 +769,60 @@ def remove_remote_objects(objhashes, conn, syncdb, etagdict):
             if dry_run:
                 continue
 
-            remove_remote_object(conn, etag, href)
-            syncdb_remove(syncdb, href)
-            deleted += 1
+            delqueue.append((etag, href))
 
-    return deleted
+    # Send the DELETE requests concurrently, using one connection per worker.
+    pool_map(lambda entry: remove_remote_object(worker_conn(), *entry),
+             delqueue)
+    for etag, href in delqueue:
+        syncdb_remove(syncdb, href)
+
+    return len(delqueue)
 
 
 def pull_objects(hrefs_missing, hrefs_modified, conn, syncdb, etagdict):
     if not hrefs_missing and not hrefs_modified:
         return 0
 
-    # Download and import new objects from the server.
-    body = ('<?xml version="1.0" encoding="utf-8" ?>'
-            '<C:calendar-multiget xmlns:D="DAV:" '
-            '                     xmlns:C="urn:ietf:params:xml:ns:caldav">'
-            '<D:prop><D:getetag /><C:calendar-data /></D:prop>')
-    for href in (hrefs_missing | hrefs_modified):
-        body += '<D:href>{}</D:href>'.format(href)
-    body += '</C:calendar-multiget>'
-    headers, body = remote_query(conn, "REPORT", absolute_uri, {}, body)
+    # Download and import new objects from the server. Objects are requested
+    # in batches to avoid a single huge response on the initial sync.
+    added = 0
+    hrefs = iter(hrefs_missing | hrefs_modified)
+    while True:
+        batch = list(itertools.islice(hrefs, multiget_batch_size))
+        if not batch:
+            break
+        added += pull_batch(batch, hrefs_modified, conn, syncdb, etagdict)
+
+    return added
 
-    root = etree.fromstring(body)
+
+def pull_batch(hrefs, hrefs_modified, conn, syncdb, etagdict):
+    body = multiget_body('<D:getetag /><C:calendar-data />', hrefs)
+    headers, body = remote_query(conn, "REPORT", absolute_uri, {}, body)
 
     added = 0
 
-    for node in root.findall(".//D:response", namespaces=nsmap):
-        hrefnode = node.find("./D:href", namespaces=nsmap)
+    for node in iter_multistatus(body):
+        if node.tag != tag_response:
+            continue
+        elements = response_elements(node)
+
+        hrefnode = elements.get(tag_href)
         if hrefnode is None:
             die_atnode('Missing href.', node)
         href = hrefnode.text
 
-        statusnode = node.find("./D:status", namespaces=nsmap)
-        if statusnode is not None:
-            status = re.match(r'HTTP.*(\d\d\d)', statusnode.text)
-            if status is None:
-                die_atnode('Could not parse status.', node)
-            statuscode = status.group(1)
-            if statuscode == '404':
-                print('Skipping missing item: {}'.format(href))
-                continue
+        if response_status(node, elements) == '404':
+            print('Skipping missing item: {}'.format(href))
+            continue
 
-        etagnode = node.find("./D:propstat/D:prop/D:getetag", namespaces=nsmap)
+        etagnode = elements.get(tag_getetag)
         if etagnode is None:
             die_atnode('Missing ETag.', node)
         etag = etagnode.text.strip('"')
 
-        cdatanode = node.find("./D:propstat/D:prop/C:calendar-data",
-                              namespaces=nsmap)
+        cdatanode = elements.get(tag_calendar_data)
         if cdatanode is None:
             die_atnode('Missing calendar data.', node)
         cdata = cdatanode.text
@@ -557,6 +850,7 @@ def pull_objects(hrefs_missing, hrefs_modified, conn, syncdb, etagdict):
         else:
             print("Failed to import object: {} ({})".format(etag, href),
                   file=sys.stderr)
+            unapplied.add(href)
 
     return added
 
@@ -586,8 +880,40 @@ def run_hook(name):
     subprocess.call(hook_path, shell=True)
 
 
-# Initialize the XML namespace map.
-nsmap = {"D": "DAV:", "C": "urn:ietf:params:xml:ns:caldav"}
+# Initialize the XML tag names in Clark notation, as reported by the parser.
+ns_dav = '{DAV:}'
+ns_caldav = '{urn:ietf:params:xml:ns:caldav}'
+tag_calendar_data = ns_caldav + 'calendar-data'
+tag_getetag = ns_dav + 'getetag'
+tag_href = ns_dav + 'href'
+tag_prop = ns_dav + 'prop'
+tag_propstat = ns_dav + 'propstat'
+tag_response = ns_dav + 'response'
+tag_status = ns_dav + 'status'
+tag_sync_token = ns_dav + 'sync-token'
+
+# Initialize the sync database file format identifier and the size of the
+# binary object hashes stored in it.
+syncdb_magic = b'calcurse-caldav syncdb 1\n'
+syncdb_hashlen = 20
+
+# Maximum number of objects to download with a single REPORT request.
+multiget_batch_size = 200
+
+# Number of times the ETag of an uploaded object is queried before giving up.
+max_etag_queries = 10
+
+# Number of connections used to upload and remove objects concurrently.
+max_connections = 4
+
+# Initialize the per-thread connection storage of the worker pool.
+worker_local = threading.local()
+worker_conns = []
+
+# Initialize the set of remote changes that could not be applied locally. If
+# it is not empty, the previous sync token is kept so that the server reports
+# these changes again on the next run.
+unapplied = set()
 
 # Initialize default values.
 if os.path.isdir(os.path.expanduser("~/.calcurse")):
@@ -684,6 +1010,10 @@ scope = config.get('OAuth2', 'Scope')
 
 custom_headers = config.section('CustomHeaders')
 
+# Compute the headers sent with every request once.
+base_headers = custom_headers.copy()
+base_headers.update(get_auth_headers())
+
 # Append data directory to calcurse command.
 if datadir:
     check_dir(datadir)
@@ -722,39 +1052,45 @@ elif ver < (4, 0, 0, 96):
 # Run the pre-sync hook.
 run_hook('pre-sync')
 
-# Create lock file.
-if os.path.exists(lockfn):
+# Create lock file. Creating it exclusively makes the check for a leftover
+# lock file and the creation a single atomic operation.
+try:
+    lockfd = os.open(lockfn, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+except FileExistsError:
     die('Leftover lock file detected. If there is no other synchronization ' +
         'instance running, please remove the lock file manually and try ' +
         'again.')
-open(lockfn, 'w')
+os.write(lockfd, str(os.getpid()).encode('utf-8'))
+os.close(lockfd)
+
+# Create the worker pool. Debug output of concurrent requests would be
+# interleaved, so only use a single worker in debug mode.
+pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1 if debug else max_connections)
 
 try:
     # Connect to the server.
     if verbose:
         print('Connecting to ' + hostname + '...')
-    conn = httplib2.Http(disable_ssl_certificate_validation=insecure_ssl)
 
     if authmethod == 'oauth2':
-        # Authenticate with OAuth2 and authorize HTTP object
+        # Authenticate with OAuth2
         cred = run_auth(authcode)
-        conn = cred.authorize(conn)
-    elif authmethod == 'basic':
-        # Add credentials to httplib2
-        conn.add_credentials(username, password)
-    else:
+    elif authmethod != 'basic':
         die('Invalid option for AuthMethod in config file. Use "basic" or "oauth2"')
 
+    conn = connect()
+
     if init:
         # In initialization mode, start with an empty synchronization database.
         if args.init == 'keep-remote':
             calcurse_wipe()
         elif args.init == 'keep-local':
             remote_wipe(conn)
-        syncdb = {}
+        syncdb, sync_token = {}, None
     else:
         # Read the synchronization database.
-        syncdb = get_syncdb(syncdbfn)
+        syncdb, sync_token = get_syncdb(syncdbfn)
 
         if not syncdb:
             die('Sync database not found or empty. Please initialize the ' +
@@ -765,21 +1101,23 @@ try:
 
     # Query the server and compute a lookup table that maps each path to its
     # current ETag.
-    etagdict = get_etags(conn)
+    old_sync_token = sync_token
+    etagdict, sync_token = get_etagdict(conn, syncdb, sync_token)
 
     # Compute object diffs.
     missing = set()
     modified = set()
-    for href in set(etagdict.keys()):
+    for href, etag in etagdict.items():
         if href not in syncdb:
             missing.add(href)
-        elif etagdict[href] != syncdb[href][0]:
+        elif etag != syncdb[href][0]:
             modified.add(href)
-    orphan = set(syncdb.keys()) - set(etagdict.keys())
+    orphan = syncdb.keys() - etagdict.keys()
 
     objhashes = calcurse_hashset()
-    new = objhashes - set([entry[1] for entry in syncdb.values()])
-    gone = set([entry[1] for entry in syncdb.values()]) - objhashes
+    synced = {entry[1] for entry in syncdb.values()}
+    new = objhashes - synced
+    gone = synced - objhashes
 
     # Retrieve new objects from the server.
     local_new = pull_objects(missing, modified, conn, syncdb, etagdict)
@@ -788,19 +1126,25 @@ try:
     local_del = remove_local_objects(orphan, conn, syncdb, etagdict)
 
     # Push new objects to the server.
-    remote_new = push_objects(new, conn, syncdb, etagdict)
+    remote_new = push_objects(new, syncdb, etagdict)
 
     # Remove items from the server if they no longer exist locally.
-    remote_del = remove_remote_objects(gone, conn, syncdb, etagdict)
+    remote_del = remove_remote_objects(gone, syncdb, etagdict)
 
     # Write the synchronization database.
-    save_syncdb(syncdbfn, syncdb)
+    if unapplied:
+        sync_token = old_sync_token
+    save_syncdb(syncdbfn, syncdb, sync_token)
 
     # Clear OAuth2 credentials if used.
     if authmethod == 'oauth2':
-        conn.clear_credentials()
+        for c in [conn] + worker_conns:
+            c.clear_credentials()
 
 finally:
+    # Stop the worker pool.
+    pool.shutdown()
+
     # Remove lock file.
     os.remove(lockfn)
 